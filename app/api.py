@@ -1,8 +1,9 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from contextlib import asynccontextmanager
 from app.schemas import QueryRequest, QueryResponse, AnalyzeRequest, ContractSchema, HealthResponse
-from app.rag_service import RAGService
-from app.contract_analyzer import ContractAnalyzer
+from app.rag_service import RAGService, QA_SYSTEM_PROMPT
+from app.contract_analyzer import ContractAnalyzer, ANALYSIS_SYSTEM_PROMPT
 import logging
 
 # Configure logging
@@ -23,6 +24,9 @@ async def lifespan(app: FastAPI):
     logger.info("Initializing RAG Service...")
     rag_service = RAGService()
     contract_analyzer = ContractAnalyzer(rag_service)
+    # Seed the prefix cache with the static system prompts so the first
+    # request per endpoint already skips their prefill.
+    await rag_service.prewarm([QA_SYSTEM_PROMPT, ANALYSIS_SYSTEM_PROMPT])
     yield
     # Clean up resources
     logger.info("Shutting down...")
@@ -37,34 +41,55 @@ def read_root():
 @app.get("/health", response_model=HealthResponse)
 def health_check():
     """Health check endpoint to verify if LLM services are loaded."""
-    status = "healthy" if rag_service and rag_service.pipe else "degraded (LLM not loaded)"
+    status = "healthy" if rag_service and rag_service.llm_available else "degraded (LLM not loaded)"
     return {"status": status}
 
 @app.post("/query", response_model=QueryResponse)
-def query_compliance(req: QueryRequest):
+async def query_compliance(req: QueryRequest):
     """
     Endpoint for Compliance Q&A.
     Uses RAG to retrieve relevant policy chunks and generate an answer.
+    Async so that concurrent queries share vLLM's continuous batches.
     """
     if not rag_service:
         raise HTTPException(status_code=503, detail="Service not initialized")
-    
-    response = rag_service.answer_question(req.question)
+
+    response = await rag_service.answer_question(req.question)
     return response
 
+@app.post("/query/stream")
+async def query_compliance_stream(req: QueryRequest):
+    """
+    Streaming variant of /query: answer tokens are flushed to the client
+    as they are decoded (plain text, no citations envelope). Time to first
+    byte is the time-to-first-token instead of the full decode.
+    """
+    if not rag_service:
+        raise HTTPException(status_code=503, detail="Service not initialized")
+
+    return StreamingResponse(
+        rag_service.answer_question_stream(req.question),
+        media_type="text/plain"
+    )
+
 @app.post("/contract/analyze", response_model=ContractSchema)
-def analyze_contract(req: AnalyzeRequest):
+async def analyze_contract(req: AnalyzeRequest):
     """
     Endpoint for Contract Analysis.
     Retrieves relevant contract sections and extracts structured data using LLM.
     """
     if not contract_analyzer:
         raise HTTPException(status_code=503, detail="Service not initialized")
-    
-    result = contract_analyzer.analyze(req.file_name)
+
+    result = await contract_analyzer.analyze(req.file_name)
     return result
 
 if __name__ == "__main__":
+    import os
     import uvicorn
-    uvicorn.run("app.api:app", host="0.0.0.0", port=8000, reload=False)
+    # More than one worker only makes sense with VLLM_SERVER_URL set, so
+    # the workers share a single vLLM server instead of each loading the
+    # model onto the GPU.
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    uvicorn.run("app.api:app", host="0.0.0.0", port=8000, workers=workers, reload=False)
 
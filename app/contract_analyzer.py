@@ -1,6 +1,12 @@
+import asyncio
 import json
 import logging
-from typing import Dict, Any, Optional, List
+import os
+from typing import Dict, Any, Optional, List, Tuple
+from jinja2 import Template
+from transformers import AutoTokenizer
+from vllm import SamplingParams
+from vllm.sampling_params import GuidedDecodingParams
 from app.rag_service import RAGService
 from app.schemas import ContractSchema, PaymentTerms
 import re
@@ -9,6 +15,54 @@ import re
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Clause types the analyzer actually consumes; each maps to a boolean
+# clause_<type> metadata flag written at ingestion time.
+ANALYZED_CLAUSE_TYPES = (
+    "parties", "effective_date", "renewal", "termination", "governing_law",
+    "confidentiality", "payment_terms", "liability", "restrictive_covenants",
+    "license_ip",
+)
+# Upper bound on chunks pulled from Chroma per analysis. The Smart Context
+# keeps at most ~3 chunks per section, so 60 is already generous.
+MAX_CHUNKS_FETCHED = 60
+
+# Static head of every analysis prompt. Byte-identical across requests so
+# vLLM's prefix caching reuses its KV blocks; per-request values (file name,
+# contract text) live in the user section. doc_id is set from file_name
+# after parsing rather than asked of the LLM.
+ANALYSIS_SYSTEM_PROMPT = """<|system|>
+You are a legal expert. Analyze the following contract text segments and extract the required fields in STRICT JSON format.
+Do not include any markdown formatting or explanation. Just the JSON.
+Fields required:
+- parties: Who are the parties?
+- effective_date: When does it start?
+- termination_clause: Summary of termination rights.
+- confidentiality_clause: Summary of confidentiality obligations.
+- governing_law: Which jurisdiction?
+- payment_terms: { "description": "...", "due_date": "..." }
+- risk_score: Integer 0-100 based on risk (high liability, strict termination = high risk).
+- notes: Any other key observations.
+
+If a field is not found, use null.
+<|end|>"""
+
+# Token budget for the Smart Context. Phi-3's window is 4096 tokens; the
+# default leaves ample room for the system prompt and the 500-token JSON
+# output, and can be raised (e.g. with a longer-context LLM_MODEL) or
+# lowered via the env var. Counting tokens (rather than the old 6000-char
+# slice) means the budget is exact regardless of how characters map to
+# tokens, and whole chunks are kept or dropped instead of truncating
+# mid-sentence.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("MAX_CTX_TOKENS", "2500"))
+
+# Compiled once at import; see QA_PROMPT_TEMPLATE in rag_service.py.
+ANALYSIS_PROMPT_TEMPLATE = Template("""{{ system_prompt }}
+<|user|>
+Contract Segments:
+{{ context_text }}
+<|end|>
+<|assistant|>""")
+
 class ContractAnalyzer:
     """
     Analyzes contract documents to extract structured information using an LLM.
@@ -17,8 +71,57 @@ class ContractAnalyzer:
     """
     def __init__(self, rag_service: RAGService):
         self.rag_service = rag_service
+        # Loaded eagerly: construction happens during app startup, so the
+        # (possibly network-bound) download never blocks the event loop on
+        # the first analysis request. If the model is unreachable (offline
+        # box, empty cache) the app must still come up degraded — the same
+        # contract _load_llm honors — so fall back to approximate counting.
+        try:
+            self._tokenizer = AutoTokenizer.from_pretrained(rag_service.model_id)
+        except Exception as e:
+            logger.error(f"Failed to load tokenizer: {e}")
+            self._tokenizer = None
 
-    def analyze(self, file_name: str) -> ContractSchema:
+    def _count_tokens(self, text: str) -> int:
+        if self._tokenizer is None:
+            # ~4 chars per token for English text; close enough for budgeting.
+            return len(text) // 4
+        return len(self._tokenizer.encode(text, add_special_tokens=False))
+
+    def _select_context(self, section_specs: List[Tuple[str, List[str], int]]) -> str:
+        """
+        Fills sections in priority order under the token budget: each
+        section keeps up to `limit` chunks, and a chunk is included only if
+        it fits in the remaining budget (greedy knapsack, so a later small
+        chunk can still use what a big one could not). CPU-bound tokenizer
+        work — callers on the event loop should run it in an executor.
+        """
+        budget = CONTEXT_TOKEN_BUDGET
+        context_parts = []
+        for header, chunks, limit in section_specs:
+            selected = []
+            for chunk in chunks[:limit]:
+                cost = self._count_tokens(chunk)
+                if cost <= budget:
+                    selected.append(chunk)
+                    budget -= cost
+            if selected:
+                context_parts.append(f"--- {header} ---\n" + "\n...\n".join(selected))
+        return "\n\n".join(context_parts)
+
+    def _get_intro_chunks(self, file_name: str, count: int = 3) -> List[str]:
+        """Fetches the first `count` chunks of a file, in document order."""
+        results = self.rag_service.collection.get(
+            where={"$and": [{"source": file_name}, {"chunk_index": {"$lt": count}}]},
+            limit=count
+        )
+        pairs = sorted(
+            zip(results['metadatas'], results['documents']),
+            key=lambda pair: pair[0].get("chunk_index", 0)
+        )
+        return [doc for _, doc in pairs]
+
+    async def analyze(self, file_name: str) -> ContractSchema:
         """
         Analyzes a specific contract file.
         1. Retrieves all chunks for the file from ChromaDB.
@@ -29,21 +132,39 @@ class ContractAnalyzer:
         """
         logger.info(f"Analyzing contract: {file_name}")
         
-        # 1. Retrieve ALL chunks for the file
-        # We fetch all chunks first and then filter in memory because Chroma's 
-        # metadata filtering is exact match, and our tags are comma-separated strings.
+        # 1. Retrieve only the chunks the Smart Context can use.
+        # Ingestion writes a boolean clause_<type> flag per detected clause,
+        # so Chroma evaluates the $or server-side instead of us pulling every
+        # chunk of the file into memory. Intro chunks (chunk_index < 3) are
+        # included because they usually hold parties/dates.
+        clause_filters = [{f"clause_{clause}": True} for clause in ANALYZED_CLAUSE_TYPES]
         results = self.rag_service.collection.get(
-            where={"source": file_name},
-            include=["documents", "metadatas"]
+            where={"$and": [{"source": file_name}, {"$or": clause_filters}]},
+            limit=MAX_CHUNKS_FETCHED
         )
-        
+
         documents = results['documents']
         metadatas = results['metadatas']
-        
+
+        if not documents:
+            # Stores ingested before the clause_* flags existed match none of
+            # the $or branches; fall back to the old full fetch for them.
+            results = self.rag_service.collection.get(
+                where={"source": file_name}
+            )
+            documents = results['documents']
+            metadatas = results['metadatas']
+
         if not documents:
             logger.warning(f"No documents found for {file_name}")
             return ContractSchema(doc_id=file_name, notes="No content found.")
 
+        # get() returns chunks in id order, which is lexicographic; restore
+        # document order so "top chunks" per section means earliest in text.
+        order = sorted(range(len(documents)), key=lambda i: metadatas[i].get("chunk_index", 0))
+        documents = [documents[i] for i in order]
+        metadatas = [metadatas[i] for i in order]
+
         # 2. Build "Smart Context"
         # Organize chunks into buckets based on their clause_type tags.
         relevant_sections = {
@@ -71,91 +192,51 @@ class ContractAnalyzer:
             # Collect high-risk sections for risk scoring
             if "liability" in tags or "restrictive_covenants" in tags or "license_ip" in tags:
                 relevant_sections["liability"].append(doc)
-            
-            # Keep first 3 chunks as "Intro/General" context (usually contains parties/dates)
-            if meta.get("chunk_index", 999) < 3:
-                relevant_sections["general"].append(doc)
-
-        def get_top_chunks(chunks: List[str], limit: int = 2) -> str:
-            """Helper to join top N chunks from a list."""
-            return "\n...\n".join(chunks[:limit])
-
-        # Construct the context string by prioritizing specific sections
-        context_parts = [
-            f"--- INTRO ---\n{get_top_chunks(relevant_sections['general'], 3)}",
-            f"--- PARTIES ---\n{get_top_chunks(relevant_sections['parties'])}",
-            f"--- DATES ---\n{get_top_chunks(relevant_sections['effective_date'])}",
-            f"--- TERMINATION ---\n{get_top_chunks(relevant_sections['termination'])}",
-            f"--- LAW ---\n{get_top_chunks(relevant_sections['governing_law'])}",
-            f"--- PAYMENT ---\n{get_top_chunks(relevant_sections['payment_terms'])}",
-            f"--- RISK FACTORS (Liability/IP/Restrictions) ---\n{get_top_chunks(relevant_sections['liability'], 3)}"
+
+        # First 3 chunks as "Intro/General" context (usually contains
+        # parties/dates): a direct range query on chunk_index, so the intro
+        # arrives in one indexed fetch regardless of clause tagging.
+        relevant_sections["general"] = self._get_intro_chunks(file_name)
+
+        # Construct the context by priority order under the token budget.
+        section_specs = [
+            ("INTRO", relevant_sections['general'], 3),
+            ("PARTIES", relevant_sections['parties'], 2),
+            ("DATES", relevant_sections['effective_date'], 2),
+            ("TERMINATION", relevant_sections['termination'], 2),
+            ("LAW", relevant_sections['governing_law'], 2),
+            ("PAYMENT", relevant_sections['payment_terms'], 2),
+            ("RISK FACTORS (Liability/IP/Restrictions)", relevant_sections['liability'], 3),
         ]
-        
-        full_context = "\n\n".join(context_parts)
-        
-        # Hard limit to ~6000 chars to prevent OOM on 8GB VRAM GPUs
-        context_text = full_context[:6000]
+
+        # Token counting is pure CPU work; run it in a thread so concurrent
+        # requests on the event loop are not stalled behind it (same pattern
+        # as QueryEmbeddingBatcher's encode).
+        loop = asyncio.get_running_loop()
+        context_text = await loop.run_in_executor(None, self._select_context, section_specs)
         
         # 3. Build Prompt
-        prompt = f"""<|system|>
-You are a legal expert. Analyze the following contract text segments and extract the required fields in STRICT JSON format.
-Do not include any markdown formatting or explanation. Just the JSON.
-Fields required:
-- doc_id: "{file_name}"
-- parties: Who are the parties?
-- effective_date: When does it start?
-- termination_clause: Summary of termination rights.
-- confidentiality_clause: Summary of confidentiality obligations.
-- governing_law: Which jurisdiction?
-- payment_terms: {{ "description": "...", "due_date": "..." }}
-- risk_score: Integer 0-100 based on risk (high liability, strict termination = high risk).
-- notes: Any other key observations.
-
-If a field is not found, use null.
-<|end|>
-<|user|>
-Contract Segments:
-{context_text}
-<|end|>
-<|assistant|>"""
+        prompt = ANALYSIS_PROMPT_TEMPLATE.render(
+            system_prompt=ANALYSIS_SYSTEM_PROMPT,
+            context_text=context_text,
+        )
 
         # 4. Generate
-        if self.rag_service.pipe:
-            # Reduced max_new_tokens to save memory
-            output = self.rag_service.pipe(prompt, max_new_tokens=500, do_sample=False)
-            generated_text = output[0]['generated_text']
-            response = generated_text.split("<|assistant|>")[-1].strip()
-            
-            # Clean up markdown code blocks if present
-            response = response.replace("```json", "").replace("```", "").strip()
-            
+        if self.rag_service.llm_available:
+            # Guided decoding constrains sampling to tokens that keep the
+            # output valid against ContractSchema's JSON schema, so the old
+            # markdown stripping and list/dict-to-string coercion passes are
+            # no longer needed: the decode cannot produce those shapes.
+            sampling_params = SamplingParams(
+                temperature=0.0,
+                max_tokens=500,
+                guided_decoding=GuidedDecodingParams(json=ContractSchema.model_json_schema()),
+            )
+            response = await self.rag_service.generate(prompt, sampling_params)
+
             try:
                 data = json.loads(response)
-                
-                # --- FIX: Handle Lists AND Dictionaries for String Fields ---
-                # LLMs sometimes return lists or dicts for fields defined as strings.
-                # We convert them to strings to satisfy Pydantic validation.
-                string_fields = ["parties", "effective_date", "termination_clause", "confidentiality_clause", "governing_law", "notes"]
-                for field in string_fields:
-                    val = data.get(field)
-                    if val:
-                        if isinstance(val, list):
-                            # Convert list to string
-                            data[field] = ", ".join([str(item) for item in val])
-                        elif isinstance(val, dict):
-                            # Convert dict to string (e.g. "key: value, key2: value2")
-                            data[field] = ", ".join([f"{k}: {v}" for k, v in val.items()])
-                
-                # Fix for payment_terms (Schema expects object, LLM might return string or list)
-                pt = data.get("payment_terms")
-                if pt:
-                    if isinstance(pt, str):
-                         data["payment_terms"] = {"description": pt}
-                    elif isinstance(pt, list):
-                        # Join list items into a single description string
-                        description = ", ".join([str(item) for item in pt])
-                        data["payment_terms"] = {"description": description}
-                
+                data["doc_id"] = file_name
                 contract_data = ContractSchema(**data)
                 return contract_data
             except json.JSONDecodeError:
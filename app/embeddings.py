@@ -1,5 +1,8 @@
-from sentence_transformers import SentenceTransformer
+import asyncio
+import os
 from typing import List
+import numpy as np
+import torch
 import logging
 
 # Configure logging
@@ -9,38 +12,209 @@ logger = logging.getLogger(__name__)
 # Global variable to hold the model instance
 _model = None
 MODEL_NAME = "sentence-transformers/all-mpnet-base-v2"
+# Encoder batch size. Bigger batches amortize kernel-launch overhead on GPU;
+# ingestion passes hundreds of chunks at a time so this is the hot knob.
+BATCH_SIZE = 128
+# Backend for the encoder: "onnx" (ONNX Runtime via optimum, operator fusion
+# and faster GEMMs) or "torch" (plain sentence-transformers). ONNX falls back
+# to torch automatically if optimum/onnxruntime are not installed.
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "onnx")
+# Dynamic INT8 quantization for CPU-only deployments (ignored on CUDA).
+EMBEDDING_INT8 = os.getenv("EMBEDDING_INT8", "0") == "1"
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ONNX_CACHE_DIR = os.path.join(BASE_DIR, "onnx_cache")
 # Note: CACHE_DIR is controlled by HF_HOME environment variable, not this variable directly.
 # Ensure HF_HOME is set before running the application if you want a custom cache location.
 
+
+class OnnxEncoder:
+    """
+    MPNet encoder served through ONNX Runtime (optimum).
+    Exposes the same encode() signature that embed_texts uses, so it is a
+    drop-in replacement for the SentenceTransformer instance. Pooling and
+    normalization are done in numpy to match sentence-transformers output.
+    """
+    def __init__(self, model_name: str):
+        import onnxruntime
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        # Ask onnxruntime what it can actually run, not torch: a GPU box
+        # with the CPU-only onnxruntime wheel has CUDA per torch but no
+        # CUDAExecutionProvider, and requesting it fails provider validation.
+        if "CUDAExecutionProvider" in onnxruntime.get_available_providers():
+            provider = "CUDAExecutionProvider"
+        elif torch.cuda.is_available():
+            # CPU ONNX on a GPU box would be slower than the FP16-on-CUDA
+            # torch encoder — refuse so get_embedding_model degrades to that
+            # instead. Install optimum[onnxruntime-gpu] to use ONNX here.
+            raise RuntimeError(
+                "CUDA is available but this onnxruntime build has no "
+                "CUDAExecutionProvider (CPU-only wheel); using the torch "
+                "backend instead. Install optimum[onnxruntime-gpu] for the "
+                "ONNX encoder on GPU."
+            )
+        else:
+            provider = "CPUExecutionProvider"
+        logger.info(f"Exporting/loading ONNX encoder ({provider})")
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_name, export=True, provider=provider
+        )
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+        if provider == "CPUExecutionProvider" and EMBEDDING_INT8:
+            self.model = self._quantize_int8(model_name)
+
+    def _quantize_int8(self, model_name: str):
+        """Applies dynamic INT8 quantization and caches the result locally."""
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+        if not os.path.exists(os.path.join(ONNX_CACHE_DIR, "model_quantized.onnx")):
+            logger.info("Quantizing encoder to INT8 (one-off)...")
+            quantizer = ORTQuantizer.from_pretrained(self.model)
+            qconfig = AutoQuantizationConfig.avx2(is_static=False)
+            quantizer.quantize(save_dir=ONNX_CACHE_DIR, quantization_config=qconfig)
+        return ORTModelForFeatureExtraction.from_pretrained(
+            ONNX_CACHE_DIR, file_name="model_quantized.onnx"
+        )
+
+    def encode(self, texts: List[str], batch_size: int = 64,
+               normalize_embeddings: bool = True, **kwargs) -> np.ndarray:
+        outputs = []
+        for i in range(0, len(texts), batch_size):
+            batch = texts[i:i + batch_size]
+            enc = self.tokenizer(
+                batch, padding=True, truncation=True, max_length=512, return_tensors="pt"
+            )
+            # Tokenizer output lands on CPU; move it to wherever the ORT
+            # session runs so the pooling below never mixes devices.
+            enc = {name: tensor.to(self.model.device) for name, tensor in enc.items()}
+            hidden = self.model(**enc).last_hidden_state
+            # Mean-pool over non-padding tokens
+            mask = enc["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+            pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+            outputs.append(pooled.cpu().numpy())
+        embeddings = np.concatenate(outputs).astype(np.float32)
+        if normalize_embeddings:
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings
+
+
 def get_embedding_model():
     """
-    Lazy loads the SentenceTransformer model.
+    Lazy loads the embedding encoder.
     Uses the global _model instance to avoid reloading on every request.
+    Prefers the ONNX Runtime backend (2-4x on encoder inference from
+    operator fusion, plus optional INT8 on CPU); falls back to
+    sentence-transformers in FP16-on-CUDA when optimum is unavailable.
     """
     global _model
     if _model is None:
-        logger.info(f"Loading embedding model: {MODEL_NAME}")
+        if EMBEDDING_BACKEND == "onnx":
+            try:
+                _model = OnnxEncoder(MODEL_NAME)
+                return _model
+            except Exception as e:
+                # Not just ImportError: the ONNX export or provider setup can
+                # fail too (e.g. mismatched onnxruntime build). The torch
+                # backend always works, so degrade instead of crashing the
+                # first embed call.
+                logger.warning(f"ONNX encoder unavailable ({e}); falling back to torch backend")
+
+        from sentence_transformers import SentenceTransformer
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        logger.info(f"Loading embedding model: {MODEL_NAME} on {device}")
         # Load model. This will download to default cache (or HF_HOME) if not present.
-        _model = SentenceTransformer(MODEL_NAME)
+        _model = SentenceTransformer(MODEL_NAME, device=device)
+        if device == "cuda":
+            _model.half()
     return _model
 
-def embed_texts(texts: List[str]) -> List[List[float]]:
+def embed_texts(texts: List[str]) -> np.ndarray:
     """
     Embeds a list of texts using the local MPNet model.
-    Returns a list of vectors (lists of floats).
-    
+    Returns the embeddings as a single float32 numpy array of shape
+    (len(texts), dim). Chroma accepts ndarrays directly, so callers
+    should pass this through without converting to Python lists.
+
     Args:
         texts: List of strings to embed.
-        
+
     Returns:
-        List of embeddings, where each embedding is a list of floats.
+        np.ndarray of L2-normalized embeddings.
     """
     if not texts:
-        return []
-        
+        return np.empty((0, 0), dtype=np.float32)
+
     model = get_embedding_model()
     # normalize_embeddings=True is good for cosine similarity
-    embeddings = model.encode(texts, convert_to_numpy=True, normalize_embeddings=True)
-    return embeddings.tolist()
+    embeddings = model.encode(
+        texts,
+        batch_size=BATCH_SIZE,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=False,
+    )
+    # The FP16-on-CUDA torch backend encodes to float16; Chroma (and the
+    # semantic cache dot products) expect float32. No-op when already f32.
+    return embeddings.astype(np.float32, copy=False)
+
+
+class QueryEmbeddingBatcher:
+    """
+    Micro-batches query embeddings across concurrent API requests.
+    Each /query request needs exactly one embedding; under load, encoding
+    them one at a time wastes most of each encoder forward pass. Awaiting
+    embed() parks the request on a queue, and a background task drains the
+    queue into a single embed_texts call: the first arrival opens a short
+    window (a few ms) and everything that lands within it shares the batch.
+    The encode runs in a thread so the event loop is never blocked.
+    """
+    def __init__(self, window_ms: float = 5.0, max_batch: int = 32):
+        self.window_s = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._worker_task = None
+
+    async def embed(self, text: str) -> np.ndarray:
+        """Returns the embedding for one text, batching with concurrent callers."""
+        loop = asyncio.get_running_loop()
+        if self._worker_task is None or self._worker_task.done():
+            self._worker_task = loop.create_task(self._worker())
+        future = loop.create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Block until a request arrives, then give concurrent callers a
+            # short window to join its batch.
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window_s
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            texts = [text for text, _ in batch]
+            try:
+                embeddings = await loop.run_in_executor(None, embed_texts, texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
 
 
+# Shared batcher for query-time embeddings (ingestion keeps calling
+# embed_texts directly with its own large batches).
+query_batcher = QueryEmbeddingBatcher()
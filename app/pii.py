@@ -1,54 +1,80 @@
 import spacy
 import logging
+from typing import List
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Only NER (and its tok2vec) is needed for masking; excluding the tagger,
+# parser and lemmatizer roughly halves per-document processing time.
+_EXCLUDE_COMPONENTS = ["tagger", "parser", "attribute_ruler", "lemmatizer"]
+
 # Load spaCy model. Ensure 'en_core_web_sm' is installed.
 # python -m spacy download en_core_web_sm
 try:
-    nlp = spacy.load("en_core_web_sm")
+    nlp = spacy.load("en_core_web_sm", exclude=_EXCLUDE_COMPONENTS)
 except OSError:
     logger.info("Downloading en_core_web_sm model...")
     from spacy.cli import download
     download("en_core_web_sm")
-    nlp = spacy.load("en_core_web_sm")
+    nlp = spacy.load("en_core_web_sm", exclude=_EXCLUDE_COMPONENTS)
+
+# Entity labels treated as PII.
+PII_LABELS = {"PERSON", "ORG", "GPE"}
+
+def _mask_doc(doc, text: str) -> str:
+    """Replaces PII entities in a parsed doc with [LABEL] placeholders."""
+    # Replacing with [LABEL] is cleaner for RAG context than '*' padding.
+    # Entities come back in document order and never overlap, so the masked
+    # text can be assembled in a single left-to-right pass: copy the span
+    # between entities, emit the placeholder, and join once at the end.
+    # (The old approach re-sliced the full string per entity, which is
+    # quadratic in text length.)
+    parts = []
+    cursor = 0
+    for ent in doc.ents:
+        if ent.label_ in PII_LABELS:
+            parts.append(text[cursor:ent.start_char])
+            parts.append(f"[{ent.label_}]")
+            cursor = ent.end_char
+    parts.append(text[cursor:])
+    return "".join(parts)
 
 def mask_pii(text: str) -> str:
     """
     Masks PII in the text using spaCy NER.
     Entities masked: PERSON, ORG, GPE.
-    
+
     Args:
         text: The input text string.
-        
+
     Returns:
         The text with PII entities replaced by [LABEL] placeholders.
     """
     if not text:
         return ""
-        
+
     doc = nlp(text)
-    
-    # We iterate and replace characters with '*' or replace the whole entity with [LABEL]
-    # Replacing with [LABEL] is cleaner for RAG context.
-    
-    # We need to be careful with replacing in-place if we change string length.
-    # Easier to rebuild string or use replacements.
-    
-    # Let's use a list of replacements and apply them.
-    replacements = []
-    for ent in doc.ents:
-        if ent.label_ in ["PERSON", "ORG", "GPE"]:
-            replacements.append((ent.start_char, ent.end_char, f"[{ent.label_}]"))
-            
-    # Sort replacements by start_char in reverse order to apply without offset issues
-    replacements.sort(key=lambda x: x[0], reverse=True)
-    
-    result = text
-    for start, end, label in replacements:
-        result = result[:start] + label + result[end:]
-        
-    return result
+    return _mask_doc(doc, text)
+
+def mask_pii_batch(texts: List[str], batch_size: int = 32) -> List[str]:
+    """
+    Masks PII in a list of texts in one go via nlp.pipe, which batches
+    documents through the NER model instead of running it once per chunk.
+    Order of the output matches the input.
+
+    Args:
+        texts: The input text strings.
+        batch_size: Number of docs spaCy processes per internal batch.
+
+    Returns:
+        List of masked texts.
+    """
+    if not texts:
+        return []
 
+    results = []
+    for doc, text in zip(nlp.pipe(texts, batch_size=batch_size), texts):
+        results.append(_mask_doc(doc, text))
+    return results
@@ -1,143 +1,357 @@
 import os
-import chromadb
-from typing import List, Dict, Tuple
+import json
+import uuid
+import httpx
+import numpy as np
+from collections import deque
+from typing import AsyncIterator, List, Dict, Tuple, Optional
 import logging
-# Import transformers only if needed to avoid overhead if just importing the class
-from transformers import pipeline, AutoModelForCausalLM, AutoTokenizer
-import torch
-from app.embeddings import embed_texts
+from jinja2 import Template
+from vllm import SamplingParams
+from vllm.engine.arg_utils import AsyncEngineArgs
+from vllm.engine.async_llm_engine import AsyncLLMEngine
+from app.embeddings import embed_texts, query_batcher
+from app.vector_store import get_collection
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-VECTOR_STORE_DIR = os.path.join(BASE_DIR, "vector_store")
-COLLECTION_NAME = "compliance_contract_docs"
-# Distance threshold for relevance. Lower is better for L2.
-# 1.0 corresponds to cosine similarity of 0.5.
-DISTANCE_THRESHOLD = 1.0 
+# Distance thresholds for relevance, per index space. Both cut at cosine
+# similarity 0.5: cosine distance is 1 - cos_sim, and for L2-normalized
+# vectors squared-L2 distance is 2 * (1 - cos_sim). The threshold is chosen
+# at startup from the space the persisted collection was actually built
+# with — a store created before the cosine switch stays in l2 until it is
+# deleted and re-ingested, and must not be cut with the cosine value.
+DISTANCE_THRESHOLDS = {
+    "cosine": 0.5,
+    "l2": 1.0,
+    "ip": 0.5,
+}
+
+# Weight/KV-cache quantization for the vLLM engine. Decode is memory-bound,
+# so halving bytes moved roughly doubles tokens/s on Ampere+/Ada GPUs.
+# "fp8" quantizes on the fly; "awq" needs a prequantized checkpoint
+# (set LLM_MODEL to e.g. an AWQ Phi-3 variant); "none" keeps FP16/BF16.
+LLM_MODEL = os.getenv("LLM_MODEL", "microsoft/Phi-3-mini-4k-instruct")
+LLM_QUANT = os.getenv("LLM_QUANT", "fp8")
+
+# When set (e.g. http://localhost:8001), generation is forwarded to a
+# standalone vLLM OpenAI-compatible server instead of an in-process
+# engine. This is how multiple Uvicorn workers share one GPU model:
+# each worker is a thin HTTP client, and the single vLLM server batches
+# requests from all of them. Leave unset for single-worker deployments.
+VLLM_SERVER_URL = os.getenv("VLLM_SERVER_URL")
+
+# Static head of every Q&A prompt. Keeping it byte-identical across
+# requests lets vLLM's prefix caching reuse its KV blocks instead of
+# re-prefilling them per request (see prewarm()).
+QA_SYSTEM_PROMPT = """<|system|>
+You are a helpful compliance assistant. Answer the question based ONLY on the provided context.
+If the answer is not in the context, say "No relevant info found."
+Include citations to the source documents.
+<|end|>"""
+
+# Compiled once at import; rendering is a cheap bytecode call per request
+# and keeps the prompt layout in one declarative place. The system prompt
+# is injected as-is so the cached-prefix bytes stay identical.
+QA_PROMPT_TEMPLATE = Template("""{{ system_prompt }}
+<|user|>
+Context:
+{{ context }}
+
+Question: {{ question }}
+<|end|>
+<|assistant|>""")
+
+# Semantic answer cache: a repeat of a near-identical question skips
+# retrieval and the whole LLM decode. Embeddings are L2-normalized, so
+# cosine similarity is a dot product; 0.97 only matches rephrasings.
+CACHE_SIMILARITY_THRESHOLD = 0.97
+CACHE_MAX_ENTRIES = 256
 
 class RAGService:
     """
     Service for Retrieval-Augmented Generation (RAG).
     Handles:
     1. Connecting to ChromaDB vector store.
-    2. Loading the local LLM (Phi-3-mini).
+    2. Loading the local LLM (Phi-3-mini) via vLLM.
     3. Retrieving relevant documents based on query embeddings.
     4. Generating answers using the LLM and retrieved context.
     """
     def __init__(self):
-        logger.info(f"Connecting to ChromaDB at {VECTOR_STORE_DIR}")
-        self.client = chromadb.PersistentClient(path=VECTOR_STORE_DIR)
-        self.collection = self.client.get_or_create_collection(name=COLLECTION_NAME)
-        
+        self.collection = get_collection()
+
+        # Chroma defaults to l2 when hnsw:space was never set on creation.
+        space = (self.collection.metadata or {}).get("hnsw:space", "l2")
+        self.distance_threshold = DISTANCE_THRESHOLDS.get(space, DISTANCE_THRESHOLDS["l2"])
+        if space != "cosine":
+            logger.warning(
+                f"Collection uses '{space}' space (pre-cosine store); "
+                "delete vector_store/ and re-run ingestion to rebuild with "
+                "the tuned cosine HNSW index."
+            )
+
         # Load LLM
-        # Using Phi-3-mini-4k-instruct
-        self.model_id = "microsoft/Phi-3-mini-4k-instruct"
-        self.pipe = None
-        self._load_llm()
+        # Using Phi-3-mini-4k-instruct (or a prequantized variant via LLM_MODEL)
+        self.model_id = LLM_MODEL
+        self.engine = None
+        self.http_client = None
+        if VLLM_SERVER_URL:
+            logger.info(f"Using shared vLLM server at {VLLM_SERVER_URL}")
+            self.http_client = httpx.AsyncClient(base_url=VLLM_SERVER_URL, timeout=120.0)
+        else:
+            self._load_llm()
+
+        # (query_embedding, response) pairs, oldest evicted first.
+        self._answer_cache = deque(maxlen=CACHE_MAX_ENTRIES)
 
     def _load_llm(self):
         """
-        Loads the Phi-3-mini model and tokenizer from local cache or Hugging Face.
-        Configures device (GPU/CPU) automatically.
+        Loads the Phi-3-mini model into a vLLM engine.
+        vLLM's PagedAttention KV cache and continuous batching give much
+        higher decode throughput than a plain transformers pipeline, and
+        the paged cache keeps VRAM usage predictable.
         """
-        logger.info(f"Loading LLM: {self.model_id}")
+        logger.info(f"Loading LLM: {self.model_id} (quant={LLM_QUANT})")
         try:
-            # Check for GPU
-            device = "cuda" if torch.cuda.is_available() else "cpu"
-            logger.info(f"Using device: {device}")
-            
-            self.tokenizer = AutoTokenizer.from_pretrained(self.model_id, trust_remote_code=True)
-            self.model = AutoModelForCausalLM.from_pretrained(
-                self.model_id, 
-                device_map=device, 
-                torch_dtype="auto", 
-                trust_remote_code=True
-            )
-            self.pipe = pipeline(
-                "text-generation",
-                model=self.model,
-                tokenizer=self.tokenizer,
+            engine_kwargs = dict(
+                model=self.model_id,
+                dtype="auto",
+                gpu_memory_utilization=0.85,
+                max_model_len=4096,
+                # Reuse KV blocks of shared prompt prefixes (the static
+                # system prompts) across requests instead of re-prefilling.
+                enable_prefix_caching=True,
             )
+            if LLM_QUANT != "none":
+                engine_kwargs["quantization"] = LLM_QUANT
+                if LLM_QUANT == "fp8":
+                    # Quantize the KV cache too: it dominates VRAM at long contexts.
+                    engine_kwargs["kv_cache_dtype"] = "fp8"
+            self.engine = AsyncLLMEngine.from_engine_args(AsyncEngineArgs(**engine_kwargs))
             logger.info("LLM loaded successfully.")
         except Exception as e:
             logger.error(f"Failed to load LLM: {e}")
-            self.pipe = None
+            self.engine = None
+
+    @property
+    def llm_available(self) -> bool:
+        """True if generation can be served (in-process engine or shared server)."""
+        return self.engine is not None or self.http_client is not None
+
+    async def generate(self, prompt: str, sampling_params: SamplingParams) -> str:
+        """
+        Runs a prompt through the vLLM backend and returns the generated
+        text (completion only, no prompt echo).
+
+        Each call registers one request with the engine; the engine's
+        scheduler packs all in-flight requests into shared batches
+        (continuous batching), so concurrent API calls speed each other
+        up rather than queueing behind one another. With VLLM_SERVER_URL
+        set, the request goes to the shared server's /v1/completions
+        endpoint and the same batching happens there, across workers.
+        """
+        if self.http_client is not None:
+            request_json = {
+                "model": self.model_id,
+                "prompt": prompt,
+                "temperature": sampling_params.temperature,
+                "max_tokens": sampling_params.max_tokens,
+            }
+            guided = sampling_params.guided_decoding
+            if guided is not None and guided.json is not None:
+                # The OpenAI-compatible server takes the schema as guided_json.
+                request_json["guided_json"] = guided.json
+            resp = await self.http_client.post("/v1/completions", json=request_json)
+            resp.raise_for_status()
+            return resp.json()["choices"][0]["text"].strip()
+
+        request_id = uuid.uuid4().hex
+        final_output = None
+        async for output in self.engine.generate(prompt, sampling_params, request_id):
+            final_output = output
+        return final_output.outputs[0].text.strip()
 
-    def retrieve(self, query: str, top_k: int = 3) -> List[Dict]:
+    async def generate_stream(self, prompt: str,
+                              sampling_params: SamplingParams) -> AsyncIterator[str]:
+        """
+        Streams the completion for a prompt as incremental text deltas.
+        Tokens reach the client as soon as they are decoded, so perceived
+        latency is the time-to-first-token rather than the full decode.
+        """
+        if self.http_client is not None:
+            request_json = {
+                "model": self.model_id,
+                "prompt": prompt,
+                "temperature": sampling_params.temperature,
+                "max_tokens": sampling_params.max_tokens,
+                "stream": True,
+            }
+            async with self.http_client.stream("POST", "/v1/completions",
+                                               json=request_json) as resp:
+                resp.raise_for_status()
+                # The vLLM server streams SSE lines: "data: {...}" / "data: [DONE]"
+                async for line in resp.aiter_lines():
+                    if not line.startswith("data: "):
+                        continue
+                    payload = line[len("data: "):]
+                    if payload == "[DONE]":
+                        break
+                    delta = json.loads(payload)["choices"][0]["text"]
+                    if delta:
+                        yield delta
+            return
+
+        request_id = uuid.uuid4().hex
+        emitted = 0
+        async for output in self.engine.generate(prompt, sampling_params, request_id):
+            text = output.outputs[0].text
+            if len(text) > emitted:
+                yield text[emitted:]
+                emitted = len(text)
+
+    def _cache_lookup(self, query_embedding: np.ndarray) -> Optional[Dict]:
+        """Returns a cached response if a near-identical query was answered."""
+        for cached_embedding, response in self._answer_cache:
+            if float(np.dot(cached_embedding, query_embedding)) >= CACHE_SIMILARITY_THRESHOLD:
+                return response
+        return None
+
+    def retrieve(self, query: str, top_k: int = 3,
+                 query_embedding: Optional[np.ndarray] = None) -> List[Dict]:
         """
         Retrieves the top_k most relevant document chunks for a given query.
+        Pass query_embedding to reuse an embedding computed by the caller.
         """
-        query_embedding = embed_texts([query])[0]
+        if query_embedding is None:
+            query_embedding = embed_texts([query])[0]
+        # Chroma accepts a 2D ndarray directly; no need to wrap the row in a list.
         results = self.collection.query(
-            query_embeddings=[query_embedding],
+            query_embeddings=query_embedding.reshape(1, -1),
             n_results=top_k
         )
-        
+
         retrieved_docs = []
         if results['documents']:
             for i, doc in enumerate(results['documents'][0]):
                 metadata = results['metadatas'][0][i]
                 distance = results['distances'][0][i]
-                
+
                 retrieved_docs.append({
                     "text": doc,
                     "metadata": metadata,
-                    "score": distance 
+                    "score": distance
                 })
         return retrieved_docs
 
-    def answer_question(self, question: str) -> Dict:
+    async def prewarm(self, prefixes: List[str]):
+        """
+        Runs a 1-token generation over each static prompt prefix so its KV
+        blocks are resident in the prefix cache before the first real
+        request; later requests then skip the prefill for that prefix.
+        No-op with a shared vLLM server, which manages its own cache.
+        """
+        if self.http_client is not None or self.engine is None:
+            return
+        sampling_params = SamplingParams(temperature=0.0, max_tokens=1)
+        for prefix in prefixes:
+            await self.generate(prefix, sampling_params)
+        logger.info(f"Prewarmed KV cache for {len(prefixes)} prompt prefixes.")
+
+    def _build_qa_prompt(self, question: str, relevant_docs: List[Dict]) -> str:
+        """Builds the Phi-3 chat prompt for a Q&A request."""
+        context = "\n\n".join([f"Source: {d['metadata']['source']}\nContent: {d['text']}" for d in relevant_docs])
+
+        return QA_PROMPT_TEMPLATE.render(
+            system_prompt=QA_SYSTEM_PROMPT,
+            context=context,
+            question=question,
+        )
+
+    async def answer_question_stream(self, question: str) -> AsyncIterator[str]:
+        """
+        Streaming variant of answer_question: yields answer text deltas as
+        they are decoded. The completed answer is added to the semantic
+        cache, so a repeat question is served instantly (as one chunk).
+        """
+        query_embedding = await query_batcher.embed(question)
+
+        cached = self._cache_lookup(query_embedding)
+        if cached is not None:
+            logger.info("Semantic cache hit; skipping retrieval and generation.")
+            yield cached["answer"]
+            return
+
+        docs = self.retrieve(question, query_embedding=query_embedding)
+        relevant_docs = [d for d in docs if d['score'] < self.distance_threshold]
+
+        if not relevant_docs:
+            yield "No relevant info found."
+            return
+
+        if not self.llm_available:
+            yield "LLM not loaded. Cannot generate answer."
+            return
+
+        prompt = self._build_qa_prompt(question, relevant_docs)
+        sampling_params = SamplingParams(temperature=0.0, max_tokens=900)
+
+        parts = []
+        async for delta in self.generate_stream(prompt, sampling_params):
+            parts.append(delta)
+            yield delta
+
+        self._answer_cache.append((query_embedding, {
+            "answer": "".join(parts).strip(),
+            "citations": list(set([d['metadata']['source'] for d in relevant_docs])),
+            "similarity_scores": [d['score'] for d in relevant_docs]
+        }))
+
+    async def answer_question(self, question: str) -> Dict:
         """
         Generates an answer to a compliance question using RAG.
-        1. Retrieves relevant chunks.
-        2. Filters chunks by similarity threshold.
-        3. Constructs a prompt with context.
-        4. Generates answer via LLM.
+        1. Checks the semantic cache for a near-identical prior question.
+        2. Retrieves relevant chunks.
+        3. Filters chunks by similarity threshold.
+        4. Constructs a prompt with context.
+        5. Generates answer via LLM and caches the result.
         """
-        docs = self.retrieve(question)
-        
+        query_embedding = await query_batcher.embed(question)
+
+        cached = self._cache_lookup(query_embedding)
+        if cached is not None:
+            logger.info("Semantic cache hit; skipping retrieval and generation.")
+            return cached
+
+        docs = self.retrieve(question, query_embedding=query_embedding)
+
         # Filter by threshold
-        relevant_docs = [d for d in docs if d['score'] < DISTANCE_THRESHOLD]
-        
+        relevant_docs = [d for d in docs if d['score'] < self.distance_threshold]
+
         if not relevant_docs:
             return {
                 "answer": "No relevant info found.",
                 "citations": [],
                 "similarity_scores": []
             }
-            
-        context = "\n\n".join([f"Source: {d['metadata']['source']}\nContent: {d['text']}" for d in relevant_docs])
-        
-        prompt = f"""<|system|>
-You are a helpful compliance assistant. Answer the question based ONLY on the provided context. 
-If the answer is not in the context, say "No relevant info found."
-Include citations to the source documents.
-<|end|>
-<|user|>
-Context:
-{context}
 
-Question: {question}
-<|end|>
-<|assistant|>"""
+        prompt = self._build_qa_prompt(question, relevant_docs)
 
-        if self.pipe:
-            output = self.pipe(prompt, max_new_tokens=900, do_sample=False)
-            generated_text = output[0]['generated_text']
-            # Extract assistant response
-            answer = generated_text.split("<|assistant|>")[-1].strip()
+        if self.llm_available:
+            sampling_params = SamplingParams(temperature=0.0, max_tokens=900)
+            answer = await self.generate(prompt, sampling_params)
         else:
             answer = "LLM not loaded. Cannot generate answer."
 
         citations = list(set([d['metadata']['source'] for d in relevant_docs]))
         scores = [d['score'] for d in relevant_docs]
 
-        return {
+        response = {
             "answer": answer,
             "citations": citations,
             "similarity_scores": scores
         }
-
+        if self.llm_available:
+            self._answer_cache.append((query_embedding, response))
+        return response
@@ -0,0 +1,48 @@
+import os
+import chromadb
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VECTOR_STORE_DIR = os.path.join(BASE_DIR, "vector_store")
+COLLECTION_NAME = "compliance_contract_docs"
+
+# HNSW index settings for the collection. Embeddings are L2-normalized, so
+# cosine is the native space (no squared-L2 detour); M and construction_ef
+# above Chroma's defaults buy recall at index build time, search_ef trades a
+# little query latency for it. Only applied when the collection is created —
+# changing them means deleting vector_store/ and re-ingesting.
+HNSW_CONFIG = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 100,
+}
+
+# Process-wide singletons. A PersistentClient owns a SQLite connection and
+# the in-memory HNSW index; creating one per caller repeats that setup and
+# risks two handles to the same store, so ingest and the RAG service share
+# these instead. This module intentionally imports nothing heavy (no vLLM,
+# no encoders) so the ingestion script stays lightweight.
+_client = None
+_collection = None
+
+def get_client() -> chromadb.PersistentClient:
+    """Returns the shared ChromaDB client, creating it on first use."""
+    global _client
+    if _client is None:
+        logger.info(f"Initializing ChromaDB at {VECTOR_STORE_DIR}")
+        _client = chromadb.PersistentClient(path=VECTOR_STORE_DIR)
+    return _client
+
+def get_collection():
+    """Returns the shared document collection, creating it on first use."""
+    global _collection
+    if _collection is None:
+        _collection = get_client().get_or_create_collection(
+            name=COLLECTION_NAME, metadata=HNSW_CONFIG
+        )
+    return _collection